@@ -1,10 +1,26 @@
 import streamlit as st
-from openai import OpenAI
-from openpyxl import load_workbook
-import graphviz
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from openai import APIError, AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from openpyxl.formula.translate import Translator
+from openpyxl.utils.cell import coordinate_to_tuple
+import pandas as pd
+import asyncio
+import diskcache
+import functools
+import hashlib
+import httpx
 import io
+import itertools
+import json
+import os
+import posixpath
 import re
+import time
+import xml.etree.ElementTree as ET
+import zipfile
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 st.set_page_config(page_title="Named Reference Dependency Viewer", layout="wide")
 
@@ -13,160 +29,847 @@ openai_api_key = st.secrets.get("OPENAI_API_KEY")
 if not openai_api_key:
     st.error("❌ OPENAI_API_KEY not found in secrets.")
     st.stop()
-client = OpenAI(api_key=openai_api_key)
 
 # --- Formula cleaner ---
+# External workbook prefixes: 'Book.xlsx'!, '[Book.xlsx]Sheet'! and [Book.xlsx]Sheet!
+EXTERNAL_REF_RE = re.compile(r"'[^']+\.xlsx'!|'\[[^\]]+\][^']*'!|\[[^\]]+\][^!]*!")
+
 def simplify_formula(formula):
     if not formula:
         return ""
-    formula = re.sub(r"'[^']+\.xlsx'!", "", formula)
-    formula = re.sub(r"\[[^\]]+\][^!]*!", "", formula)
-    return formula
+    return EXTERNAL_REF_RE.sub("", formula)
+
+# Excel names are identifiers (letters, digits, "_" and "."), so a formula can be split
+# into its identifier tokens once and looked up in the set of known labels. Sheet-qualified
+# names (Q1!Total, 'My Sheet'!Total) keep their sheet so they reach that sheet's scoped name.
+TOKEN_RE = re.compile(r"(?:'((?:[^']|'')+)'|([^\W\d][\w.]*))!([^\W\d][\w.]*)|([^\W\d][\w.]*)")
+
+def formula_tokens(formula):
+    # (sheet, NAME) pairs, with "" as the sheet of unqualified names. Upper-cased because
+    # Excel names and sheet names are case-insensitive.
+    tokens = set()
+    for quoted_sheet, sheet, qualified_name, name in TOKEN_RE.findall(formula.upper()):
+        if qualified_name:
+            tokens.add((quoted_sheet.replace("''", "'") or sheet, qualified_name))
+        else:
+            tokens.add(("", name))
+    return sorted(tokens)
+
+# --- Read the workbook package directly ---
+# Only workbook.xml, its relationships and the sheets that host a defined name are
+# parsed; styles and unreferenced sheets are never touched, and shared strings only
+# when a target cell holds text.
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+def read_workbook(z):
+    root = ET.parse(z.open("xl/workbook.xml")).getroot()
+    rels = ET.parse(z.open("xl/_rels/workbook.xml.rels")).getroot()
+
+    targets = {}
+    for rel in rels.iter(f"{PKG_REL_NS}Relationship"):
+        target = rel.get("Target")
+        targets[rel.get("Id")] = target.lstrip("/") if target.startswith("/") else posixpath.join("xl", target)
+
+    sheet_paths = {
+        sheet.get("name"): targets.get(sheet.get(f"{REL_NS}id"))
+        for sheet in root.iter(f"{MAIN_NS}sheet")
+    }
+    sheet_names = list(sheet_paths)
+    defined_names = []
+    for dn in root.iter(f"{MAIN_NS}definedName"):
+        name = dn.get("name")
+        if name.startswith("_xlnm."):
+            # Built-ins such as print areas and autofilter ranges
+            continue
+        # localSheetId is the position of the sheet a name is scoped to
+        local_id = dn.get("localSheetId")
+        if local_id is None:
+            scope = "Workbook"
+        elif local_id.isdigit() and int(local_id) < len(sheet_names):
+            scope = sheet_names[int(local_id)]
+        else:
+            continue
+        defined_names.append((name, dn.text or "", scope))
+    return sheet_paths, defined_names
+
+def read_shared_strings(z):
+    # Phonetic runs (<rPh>) are reading hints, not part of the displayed text
+    strings = []
+    with z.open("xl/sharedStrings.xml") as strings_xml:
+        for _, elem in ET.iterparse(strings_xml):
+            if elem.tag == f"{MAIN_NS}si":
+                # Plain text is a direct <t>; rich text is a sequence of <r><t> runs
+                runs = elem.findall(f"{MAIN_NS}t") or elem.findall(f"{MAIN_NS}r/{MAIN_NS}t")
+                strings.append("".join(t.text or "" for t in runs))
+                elem.clear()
+    return strings
+
+def read_cell_value(c, shared_strings):
+    if c.get("t") == "inlineStr":
+        return "".join(c.itertext())
+    v = c.find(f"{MAIN_NS}v")
+    if v is None:
+        return None
+    if c.get("t") == "s":
+        return shared_strings()[int(v.text)]
+    return v.text
+
+def read_cells(z, sheet_path, cell_refs, shared_strings):
+    # Stream the sheet XML and stop as soon as the last requested row has been read
+    targets = set(cell_refs)
+    last_row = max(coordinate_to_tuple(cell_ref)[0] for cell_ref in targets)
+    shared = {}
+    found = {}
+
+    with z.open(sheet_path) as sheet_xml:
+        for _, elem in ET.iterparse(sheet_xml):
+            if elem.tag == f"{MAIN_NS}c":
+                cell_ref = elem.get("r")
+                f = elem.find(f"{MAIN_NS}f")
+                if f is not None and f.text and f.get("t") == "shared":
+                    # Only the master is kept; translation is paid for target cells alone
+                    shared[f.get("si")] = ("=" + f.text, cell_ref)
+                if cell_ref in targets:
+                    formula = None
+                    if f is not None:
+                        if f.text:
+                            formula = "=" + f.text
+                        elif f.get("t") == "shared" and f.get("si") in shared:
+                            master_formula, master_ref = shared[f.get("si")]
+                            formula = Translator(master_formula, origin=master_ref).translate_formula(cell_ref)
+                    found[cell_ref] = (formula, read_cell_value(elem, shared_strings))
+                    if len(found) == len(targets):
+                        break
+            elif elem.tag == f"{MAIN_NS}row":
+                if int(elem.get("r", 0)) >= last_row:
+                    break
+                elem.clear()
+
+    return found
 
 # --- Extract named references with reliable formula handling ---
-def extract_named_references(wb, file_label):
+# A defined name that points at cells is a comma-separated list of Sheet!A1 or 'My Sheet'!A1:B2
+# Groups: quoted sheet, bare sheet, full ref, then the top-left cell's column and row
+DEST_RE = re.compile(r"(?:'((?:[^']|'')+)'|([^'!,\s]+))!(\$?([A-Za-z]{1,3})\$?(\d+)(?::\$?[A-Za-z]{1,3}\$?\d+)?)")
+DESTS_RE = re.compile(rf"{DEST_RE.pattern}(?:,{DEST_RE.pattern})*")
+EXTERNAL_RE = re.compile(r"^\[\d+\]")
+
+def iter_destinations(attr_text):
+    if EXTERNAL_RE.match(attr_text) or not DESTS_RE.fullmatch(attr_text):
+        return
+    for m in DEST_RE.finditer(attr_text):
+        sheet_name = m.group(1).replace("''", "'") if m.group(1) else m.group(2)
+        yield sheet_name, m.group(3), f"{m.group(4).upper()}{m.group(5)}"
+
+def extract_named_references(file, file_label):
+    # Returns (named_refs, log lines). Nothing is written to the page here, so this can
+    # run on worker threads; callers render the log on the script thread.
     named_refs = {}
+    log = []
+    per_sheet = defaultdict(list)
 
-    for name in wb.defined_names:
-        dn = wb.defined_names[name]
-        if dn.is_external or not dn.attr_text:
-            continue
-        for sheet_name, ref in dn.destinations:
-            label = name
-            try:
-                sheet = wb[sheet_name]
-                coord = ref.replace("$", "").split("!")[-1]
-                top_left_cell = coord.split(":")[0]
-                cell = sheet[top_left_cell]
+    with zipfile.ZipFile(file) as z:
+        sheet_paths, defined_names = read_workbook(z)
+        # Loaded on the first text cell and reused for the rest of this workbook
+        shared_strings = functools.lru_cache(maxsize=None)(lambda: read_shared_strings(z))
+
+        for name, attr_text, scope in defined_names:
+            # Copying a sheet duplicates its names with sheet scope, so those get their own key
+            label = name if scope == "Workbook" else f"{scope}!{name}"
+            for sheet_name, ref, top_left_cell in iter_destinations(attr_text):
+                if ":" in ref:
+                    # Multi-cell ranges name inputs and tables in practice, so don't open the sheet for them
+                    log.append(f"⏭️ `{label}` at `{sheet_name}!{ref}` is a range; formula lookup skipped.")
+                    named_refs[label] = {
+                        "name": name,
+                        "sheet": sheet_name,
+                        "ref": ref,
+                        "scope": scope,
+                        "formulas": [],
+                        "tokens": [],
+                        "file": file_label
+                    }
+                    continue
+                per_sheet[sheet_name].append((label, name, ref, top_left_cell, scope))
 
-                raw_formula = None
+        for sheet_name, targets in per_sheet.items():
+            try:
+                if not sheet_paths.get(sheet_name):
+                    raise KeyError(f"Worksheet {sheet_name} does not exist.")
+                cells = read_cells(z, sheet_paths[sheet_name], [top_left_cell for _, _, _, top_left_cell, _ in targets], shared_strings)
+            except Exception as e:
+                for label, _, _, _, _ in targets:
+                    log.append(f"❌ Error processing `{label}` → {e}")
+                continue
 
-                if isinstance(cell.value, str) and cell.value.startswith("="):
-                    raw_formula = cell.value.strip()
-                elif hasattr(cell.value, "text"):
-                    raw_formula = str(cell.value.text).strip()
+            for label, name, ref, top_left_cell, scope in targets:
+                raw_formula, value = cells.get(top_left_cell, (None, None))
 
-                if raw_formula and raw_formula.startswith("="):
+                if raw_formula:
                     simplified = simplify_formula(raw_formula)
-                    st.write(f"✅ `{label}` at `{sheet_name}!{top_left_cell}` = {raw_formula} → simplified: `{simplified}`")
+                    log.append(f"✅ `{label}` at `{sheet_name}!{top_left_cell}` = {raw_formula} → simplified: `{simplified}`")
                     formulas = [simplified]
+                    tokens = formula_tokens(simplified)
                 else:
-                    st.write(f"⚠️ `{label}` at `{sheet_name}!{top_left_cell}` has no formula. Value = `{cell.value}`")
+                    log.append(f"⚠️ `{label}` at `{sheet_name}!{top_left_cell}` has no formula. Value = `{value}`")
                     formulas = []
+                    tokens = []
 
                 named_refs[label] = {
+                    "name": name,
                     "sheet": sheet_name,
                     "ref": ref,
+                    "scope": scope,
                     "formulas": formulas,
+                    "tokens": tokens,
                     "file": file_label
                 }
 
-            except Exception as e:
-                st.write(f"❌ Error processing `{label}` → {e}")
+    return named_refs, log
 
-    return named_refs
+@st.cache_data(show_spinner=False)
+def extract_named_references_from_bytes(file_bytes, file_label):
+    # Keyed on the file content, so reruns and identical uploads skip parsing
+    return extract_named_references(io.BytesIO(file_bytes), file_label)
 
 # --- Dependency detection ---
+@st.cache_data(show_spinner=False)
 def find_dependencies(named_refs):
-    dependencies = defaultdict(list)
-    all_labels = list(named_refs.keys())
+    # Maps each label to the set of labels its formulas reference
+    dependencies = defaultdict(set)
+    # Excel names are case-insensitive. A bare name resolves to the one scoped to the
+    # formula's own sheet first and the workbook-scoped one otherwise; Sheet!Name only
+    # ever means the name scoped to that sheet.
+    workbook_labels = {}
+    sheet_labels = defaultdict(dict)
+    for label, info in named_refs.items():
+        name = info.get("name", label).upper()
+        if info.get("scope", "Workbook") == "Workbook":
+            workbook_labels[name] = label
+        else:
+            sheet_labels[(info.get("file"), info["scope"].upper())][name] = label
 
     for target_label, info in named_refs.items():
-        formula_text = " ".join(info.get("formulas", []))
-        for other_label in all_labels:
-            if other_label == target_label:
-                continue
-            if re.search(rf"\b{re.escape(other_label)}\b", formula_text):
-                dependencies[target_label].append(other_label)
+        # Formulas are tokenized once at extraction (and cached with it)
+        tokens = info.get("tokens")
+        if not tokens:
+            # Input cells (often half the names) have nothing to match
+            continue
+        scoped = sheet_labels.get((info.get("file"), info["sheet"].upper()), {})
+        # One hash probe per token keeps this linear in formula size, not label count
+        found = set()
+        for sheet, token in tokens:
+            if sheet:
+                label = sheet_labels.get((info.get("file"), sheet), {}).get(token)
+            else:
+                label = scoped.get(token) or workbook_labels.get(token)
+            if label and label != target_label:
+                found.add(label)
+        if found:
+            dependencies[target_label] = found
 
     return dependencies
 
 # --- Graphviz graph ---
-def create_dependency_graph(dependencies, all_labels):
-    dot = graphviz.Digraph()
-    for label in all_labels:
-        dot.node(label)
+DOT_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"'})
+LARGE_GRAPH_NODES = 500
+WHOLE_GRAPH = "(all references)"
+
+def dot_id(label):
+    return '"' + label.translate(DOT_ESCAPES) + '"'
+
+def neighbourhood(dependencies, focus, depth):
+    # Labels within `depth` hops of `focus`, following edges in both directions
+    adjacent = defaultdict(set)
     for target, sources in dependencies.items():
+        adjacent[target] |= sources
         for source in sources:
-            dot.edge(source, target)
-    return dot
+            adjacent[source].add(target)
+    reached, frontier = {focus}, {focus}
+    for _ in range(depth):
+        frontier = {label for node in frontier for label in adjacent[node]} - reached
+        reached |= frontier
+    return reached
+
+def create_dependency_graph(dependencies, all_labels, named_refs=None):
+    # Emit DOT source directly; Digraph.node/edge cost a Python call and quoting pass each
+    all_labels = set(all_labels)
+    lines = ["digraph {"]
+    if len(all_labels) > LARGE_GRAPH_NODES:
+        # Left-to-right ranks keep wide dependency fans from stretching the layout
+        lines.append("    graph [rankdir=LR];")
+    if named_refs and len(all_labels) > LARGE_GRAPH_NODES:
+        # Per-sheet clusters let dot lay out each sheet separately
+        by_sheet = defaultdict(list)
+        for label in sorted(all_labels):
+            info = named_refs[label]
+            by_sheet[(info["file"], info["sheet"])].append(label)
+        for index, ((file_name, sheet), labels) in enumerate(by_sheet.items()):
+            lines.append(f"    subgraph cluster_{index} {{")
+            lines.append(f"        label={dot_id(f'{file_name} / {sheet}')};")
+            lines.extend(f"        {dot_id(label)};" for label in labels)
+            lines.append("    }")
+    else:
+        lines.extend(f"    {dot_id(label)};" for label in sorted(all_labels))
+    lines.extend(
+        f"    {dot_id(source)} -> {dot_id(target)};"
+        for target, sources in dependencies.items() if target in all_labels
+        for source in sorted(sources) if source in all_labels
+    )
+    lines.append("}")
+    # st.graphviz_chart renders DOT source strings directly
+    return "\n".join(lines)
 
 # --- GPT Explanation ---
-def call_openai(prompt, max_tokens=200):
+# Only models that support JSON response_format, which the batched prompt relies on
+MODEL_OPTIONS = ["gpt-4o-mini", "gpt-4.1-mini", "gpt-4o"]
+MODEL = st.sidebar.selectbox("Model", MODEL_OPTIONS, index=0)
+# Long formulas (deeply nested IFs, LOOKUP chains) and failed answers go to the larger model
+COMPLEX_MODEL = "gpt-4o"
+COMPLEX_FORMULA_LENGTH = 200
+BATCH_SIZE = 20
+MAX_CONCURRENCY = 16
+TEMPERATURE = 0
+
+@st.cache_resource
+def open_answer_cache():
+    # Opened once per server process rather than on every rerun, next to app.py so the
+    # cache doesn't depend on the directory streamlit was started from
+    return diskcache.Cache(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".openai_cache"))
+
+CACHE = open_answer_cache()
+
+def cache_key(*parts):
+    return hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()
+
+def model_for(formula):
+    return COMPLEX_MODEL if len(formula) > COMPLEX_FORMULA_LENGTH else MODEL
+
+STRING_LITERAL_RE = re.compile(r'("(?:[^"]|"")*")')
+
+def normalize_formula(formula):
+    # Excel ignores case and repeated whitespace outside string literals, so formulas that
+    # differ only in those share one cached explanation. Single spaces are kept because a
+    # space is Excel's range-intersection operator.
+    parts = STRING_LITERAL_RE.split(formula.strip())
+    return "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part).upper()
+        for i, part in enumerate(parts)
+    )
+
+def explanation_key(formula, model=None):
+    return cache_key(model or model_for(formula), TEMPERATURE, "explain", normalize_formula(formula))
+
+def is_error(text):
+    return text.startswith("(Error:")
+
+backoff = wait_random_exponential(min=1, max=30)
+MAX_RETRY_AFTER = 60
+
+def wait_for_rate_limit(retry_state):
+    # Honour the server's retry-after hint on 429s (capped, so one reply can't stall the run);
+    # otherwise back off exponentially with jitter
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    try:
+        return min(max(float(response.headers.get("retry-after")), 0), MAX_RETRY_AFTER)
+    except (AttributeError, TypeError, ValueError):
+        return backoff(retry_state)
+
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_for_rate_limit,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def create_completion(client, semaphore, **kwargs):
+    async with semaphore:
+        return await client.chat.completions.create(**kwargs)
+
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_for_rate_limit,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def stream_completion(client, semaphore, on_text, **kwargs):
+    # Like create_completion, but calls on_text(text_so_far) as tokens arrive
+    async with semaphore:
+        stream = await client.chat.completions.create(stream=True, **kwargs)
+        parts = []
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                if "}" in delta:
+                    on_text("".join(parts))
+        return "".join(parts)
+
+ITEM_START_RE = re.compile(r'\{\s*"index"')
+JSON_DECODER = json.JSONDecoder()
+
+def parse_streamed_items(text, pos):
+    # Decode every complete {"index": ...} object after pos in a partial JSON reply.
+    # Returns the items and where to resume once more text has arrived.
+    items = []
+    while True:
+        m = ITEM_START_RE.search(text, pos)
+        if not m:
+            return items, pos
+        try:
+            item, pos = JSON_DECODER.raw_decode(text, m.start())
+        except ValueError:
+            return items, m.start()
+        items.append(item)
+
+async def call_openai(client, semaphore, prompt, max_tokens=200, model=MODEL):
+    key = cache_key(model, max_tokens, TEMPERATURE, prompt)
+    cached = CACHE.get(key)
+    if cached is not None:
+        return cached
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = await create_completion(
+            client, semaphore,
+            model=model,
             messages=[{"role": "user", "content": prompt}],
-            temperature=0.2,
+            temperature=TEMPERATURE,
             max_tokens=max_tokens
         )
-        return response.choices[0].message.content.strip()
     except Exception as e:
+        # Rate limits, auth and network failures wouldn't go better on a larger model
         return f"(Error: {e})"
 
-@st.cache_data(show_spinner=False)
-def generate_ai_outputs(named_refs):
-    results = []
-    for label, info in named_refs.items():
-        formulas = info.get("formulas", [])
-        combined_formula = " + ".join(formulas)
-        if not combined_formula:
-            doc = "No formula."
-            py = ""
-        else:
-            doc = call_openai(f"Explain this Excel formula:\n{combined_formula}", max_tokens=100)
-            py = call_openai(f"Translate this Excel formula to Python:\n{combined_formula}", max_tokens=100)
-        results.append({
+    text = (response.choices[0].message.content or "").strip()
+    if not text:
+        # Only an unusable answer is worth retrying on the larger model
+        if model != COMPLEX_MODEL:
+            return await call_openai(client, semaphore, prompt, max_tokens, COMPLEX_MODEL)
+        return "(Error: empty response)"
+    CACHE.set(key, text)
+    return text
+
+# Translations are short code snippets, so they get a tighter output budget
+PROMPT_MAX_TOKENS = {"explain": 100, "translate": 80}
+
+def explanation_prompts(formula):
+    return {
+        "explain": f"Explain this Excel formula:\n{formula}",
+        "translate": f"Translate this Excel formula to Python:\n{formula}"
+    }
+
+async def explain_formula(client, semaphore, formula, model=MODEL):
+    prompts = explanation_prompts(formula)
+    return tuple(await asyncio.gather(
+        call_openai(client, semaphore, prompts["explain"], max_tokens=PROMPT_MAX_TOKENS["explain"], model=model),
+        call_openai(client, semaphore, prompts["translate"], max_tokens=PROMPT_MAX_TOKENS["translate"], model=model)
+    ))
+
+def batch_item_answer(item):
+    # (doc, py) from one {"index", "doc", "py"} item, or None when either half is missing,
+    # null or blank, so it is never cached as an answer
+    doc, py = item["doc"], item["py"]
+    if not isinstance(doc, str) or not isinstance(py, str) or not doc.strip() or not py.strip():
+        return None
+    return doc.strip(), py.strip()
+
+async def explain_formula_batch(client, semaphore, formulas, model=MODEL, on_answer=None):
+    # on_answer(position, (doc, py)) reports answers while the reply is still streaming
+    numbered = "\n".join(f"{i}) {formula}" for i, formula in enumerate(formulas, start=1))
+    prompt = (
+        "For each of the following Excel formulas, give a short explanation and a Python translation. "
+        'Return a JSON object of the form {"results": [{"index": 1, "doc": "...", "py": "..."}, ...]} '
+        "with one entry per formula.\n" + numbered
+    )
+    resume_at = 0
+
+    def on_text(text):
+        nonlocal resume_at
+        items, resume_at = parse_streamed_items(text, resume_at)
+        for item in items:
+            try:
+                position = int(item["index"]) - 1
+                answer = batch_item_answer(item)
+            except (KeyError, TypeError, ValueError):
+                continue
+            if on_answer and answer and 0 <= position < len(formulas):
+                on_answer(position, answer)
+
+    try:
+        content = await stream_completion(
+            client, semaphore, on_text,
+            model=model,
+            response_format={"type": "json_object"},
+            messages=[{"role": "user", "content": prompt}],
+            temperature=TEMPERATURE,
+            max_tokens=150 * len(formulas)
+        )
+    except APIError as e:
+        # Rate limits, auth, timeouts and bad requests would fail the same way per formula
+        return [(f"(Error: {e})", f"(Error: {e})")] * len(formulas)
+
+    try:
+        # The complete reply is authoritative; streamed items were only for display
+        results = json.loads(content)["results"]
+        by_index = {int(item["index"]): item for item in results}
+        answers = [batch_item_answer(by_index[i]) for i in range(1, len(formulas) + 1)]
+    except (KeyError, TypeError, ValueError):
+        # Malformed or incomplete JSON: fall back to one request per formula
+        return await asyncio.gather(*(explain_formula(client, semaphore, formula, model) for formula in formulas))
+
+    # Empty answers are re-asked one by one on the larger model
+    unanswered = [i for i, answer in enumerate(answers) if answer is None]
+    retried = await asyncio.gather(*(
+        explain_formula(client, semaphore, formulas[i], COMPLEX_MODEL) for i in unanswered
+    ))
+    for i, answer in zip(unanswered, retried):
+        answers[i] = answer
+    return answers
+
+async def explain_formulas(formulas, on_progress=None):
+    # on_progress(answers) is called as answers stream in; unanswered entries are None
+    models = [model_for(formula) for formula in formulas]
+    keys = [explanation_key(formula) for formula in formulas]
+    answers = [CACHE.get(key) for key in keys]
+    answers = [tuple(answer) if answer is not None else None for answer in answers]
+    misses = defaultdict(list)
+    for i, answer in enumerate(answers):
+        if answer is None:
+            misses[models[i]].append(i)
+    if not misses:
+        return answers
+
+    # Batches never mix models; each one remembers the formula positions it answers
+    chunks = [
+        (model, indices[start:start + BATCH_SIZE])
+        for model, indices in misses.items()
+        for start in range(0, len(indices), BATCH_SIZE)
+    ]
+    # The client is scoped to this event loop: pooled connections can't outlive asyncio.run,
+    # so st.cache_resource can't share it across reruns. Within a run, all requests are
+    # multiplexed over HTTP/2 with one TLS handshake and a pool sized to the semaphore.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    http_client = DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+    )
+    # max_retries=0: tenacity is the only retry layer, so a call makes at most 6 attempts
+    async with AsyncOpenAI(api_key=openai_api_key, http_client=http_client, timeout=60, max_retries=0) as client:
+        async def run_chunk(model, indices):
+            def on_answer(position, answer):
+                answers[indices[position]] = answer
+                on_progress(answers)
+
+            batch = await explain_formula_batch(
+                client, semaphore, [formulas[i] for i in indices], model,
+                on_answer if on_progress else None
+            )
+            return indices, batch
+
+        if on_progress:
+            on_progress(answers)
+        for next_done in asyncio.as_completed([run_chunk(model, indices) for model, indices in chunks]):
+            indices, batch = await next_done
+            for i, answer in zip(indices, batch):
+                answers[i] = tuple(answer)
+                if not any(is_error(text) for text in answer):
+                    CACHE.set(keys[i], list(answer))
+            if on_progress:
+                on_progress(answers)
+
+    return answers
+
+def input_rows(combined):
+    # Input cells never reach the AI path: no cache keys, no prompts, rows built once
+    return {
+        label: {
             "Named Reference": label,
-            "AI Documentation": doc,
-            "Excel Formula": combined_formula,
-            "Python Formula": py
-        })
+            "AI Documentation": "No formula.",
+            "Excel Formula": "",
+            "Python Formula": ""
+        }
+        for label, formula in combined.items() if not formula
+    }
+
+def build_rows(combined, explanations, fixed_rows):
+    # Rows follow extraction order; only formula rows are rebuilt as answers arrive
+    results = []
+    for label, formula in combined.items():
+        row = fixed_rows.get(label)
+        if row is None:
+            doc, py = explanations.get(formula) or ("⏳ Pending...", "⏳ Pending...")
+            row = {
+                "Named Reference": label,
+                "AI Documentation": doc,
+                "Excel Formula": formula,
+                "Python Formula": py
+            }
+        results.append(row)
     return results
 
+def combine_formulas(named_refs):
+    return {label: " + ".join(info.get("formulas", [])) for label, info in named_refs.items()}
+
+def distinct_formulas(combined):
+    # Copied cells and template workbooks repeat formulas; explain each distinct one once
+    return list(dict.fromkeys(formula for formula in combined.values() if formula))
+
+PROGRESS_INTERVAL = 0.5
+
+def generate_ai_outputs(named_refs, on_progress=None):
+    # Not wrapped in st.cache_data: progress is drawn into a placeholder owned by the caller,
+    # which cached replay can't support. Repeat runs are answered from the disk cache.
+    combined = combine_formulas(named_refs)
+    fixed_rows = input_rows(combined)
+    unique_formulas = distinct_formulas(combined)
+
+    # Every streamed answer would otherwise rebuild and resend the whole table; the caller
+    # draws the final table once this returns
+    last_report = float("-inf")
+
+    def report(answers):
+        nonlocal last_report
+        now = time.monotonic()
+        if now - last_report < PROGRESS_INTERVAL:
+            return
+        last_report = now
+        on_progress(build_rows(combined, dict(zip(unique_formulas, answers)), fixed_rows))
+
+    answers = []
+    if unique_formulas:
+        answers = asyncio.run(explain_formulas(unique_formulas, report if on_progress else None))
+    return build_rows(combined, dict(zip(unique_formulas, answers)), fixed_rows)
+
+# --- OpenAI Batch API ---
+# Batch jobs cost half as much as live requests but can take minutes to finish. They only
+# fill the disk cache; generate_ai_outputs then renders everything from cache.
+BATCH_POLL_SECONDS = 10
+BATCH_DONE_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+def submit_batch_job(formulas, models):
+    lines = []
+    for i, (formula, model) in enumerate(zip(formulas, models)):
+        for kind, prompt in explanation_prompts(formula).items():
+            lines.append(json.dumps({
+                "custom_id": f"{i}::{kind}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": [{"role": "user", "content": prompt}],
+                    "temperature": TEMPERATURE,
+                    "max_tokens": PROMPT_MAX_TOKENS[kind]
+                }
+            }))
+    client = OpenAI(api_key=openai_api_key)
+    batch_file = client.files.create(file=("formulas.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+def wait_for_batch_job(batch_id, status):
+    client = OpenAI(api_key=openai_api_key)
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        done = f" ({counts.completed}/{counts.total})" if counts else ""
+        status.update(label=f"OpenAI batch job `{batch_id}`: {batch.status}{done}")
+        if batch.status in BATCH_DONE_STATUSES:
+            return batch
+        time.sleep(BATCH_POLL_SECONDS)
+
+def store_batch_results(batch, formulas, models):
+    if not batch.output_file_id:
+        return
+    client = OpenAI(api_key=openai_api_key)
+    texts = defaultdict(dict)
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        result = json.loads(line)
+        body = (result.get("response") or {}).get("body") or {}
+        choices = body.get("choices") or [{}]
+        content = ((choices[0].get("message") or {}).get("content") or "").strip()
+        if not content:
+            # Failed requests and null or empty replies are explained live instead
+            continue
+        index, kind = result["custom_id"].split("::")
+        texts[int(index)][kind] = content
+    # Formulas with a failed half stay uncached and are explained live afterwards
+    for index, answer in texts.items():
+        if "explain" in answer and "translate" in answer:
+            # Keyed by the model the job ran with, even if the sidebar has changed since
+            CACHE.set(explanation_key(formulas[index], models[index]), [answer["explain"], answer["translate"]])
+
+def run_batch_job(named_refs):
+    # Fills the cache for uncached formulas. The job id lives in session_state, so reruns
+    # while waiting poll the same job instead of submitting another.
+    formulas = [
+        formula for formula in distinct_formulas(combine_formulas(named_refs))
+        if CACHE.get(explanation_key(formula)) is None
+    ]
+    if not formulas:
+        return
+
+    jobs = st.session_state.setdefault("batch_jobs", {})
+    failed_jobs = st.session_state.setdefault("failed_batch_jobs", set())
+    # A different model selection is a different job, not a reuse of the one in flight
+    models = [model_for(formula) for formula in formulas]
+    job_key = cache_key(*zip(models, formulas))
+    if job_key in failed_jobs:
+        # Already failed this session; the same formulas go to live requests instead
+        return
+    if job_key not in jobs:
+        jobs[job_key] = (submit_batch_job(formulas, models), models)
+    batch_id, models = jobs[job_key]
+
+    with st.status("Submitting OpenAI batch job...") as status:
+        batch = wait_for_batch_job(batch_id, status)
+        del jobs[job_key]
+        if batch.status != "completed":
+            failed_jobs.add(job_key)
+            status.update(label=f"OpenAI batch job {batch.status}; falling back to live requests", state="error")
+            return
+        store_batch_results(batch, formulas, models)
+        status.update(label="OpenAI batch job completed", state="complete")
+
 # --- Markdown table ---
 def render_markdown_table(rows):
     headers = ["Named Reference", "AI Documentation", "Excel Formula", "Python Formula"]
-    md = "| " + " | ".join(headers) + " |\n"
-    md += "| " + " | ".join(["---"] * len(headers)) + " |\n"
+    parts = [
+        "| " + " | ".join(headers) + " |",
+        "| " + " | ".join(["---"] * len(headers)) + " |"
+    ]
     for row in rows:
-        md += "| " + " | ".join([
+        parts.append("| " + " | ".join([
             str(row["Named Reference"]),
             str(row["AI Documentation"]).replace("\n", " "),
             str(row["Excel Formula"]).replace("\n", " "),
             str(row["Python Formula"]).replace("\n", " ")
-        ]) + " |\n"
-    return md
+        ]) + " |")
+    return "\n".join(parts) + "\n"
+
+# --- Upload pipeline ---
+MAX_PARSE_WORKERS = 8
+
+def parse_upload(upload):
+    file_name, file_bytes = upload
+    try:
+        refs, log = extract_named_references_from_bytes(file_bytes, file_name)
+        return refs, log, None
+    except Exception as e:
+        return {}, [], e
+
+@st.cache_data(show_spinner=False)
+def process_files(signature, _files):
+    # Keyed on (name, sha1) per upload only; the bytes themselves are not re-hashed.
+    if len(_files) == 1:
+        # A single upload gains nothing from a pool; parse it on the script thread
+        outcomes = [parse_upload(_files[0])]
+    else:
+        # Workbooks are independent, and zlib/XML parsing releases the GIL, so parse them on
+        # a thread pool. Workers share the script context so the per-file cache still applies.
+        with ThreadPoolExecutor(
+            max_workers=min(MAX_PARSE_WORKERS, len(_files)),
+            initializer=add_script_run_ctx,
+            initargs=(None, get_script_run_ctx())
+        ) as executor:
+            outcomes = list(executor.map(parse_upload, _files))
+
+    combined_named_refs = {}
+    for (file_name, _), (refs, log, error) in zip(_files, outcomes):
+        if error is not None:
+            st.error(f"❌ Error reading {file_name}: {error}")
+            continue
+        if log:
+            # One element per file rather than per reference; "  \n" is a markdown line break
+            st.markdown("  \n".join(log))
+        combined_named_refs.update(refs)
+
+    return combined_named_refs, find_dependencies(combined_named_refs)
 
 # --- Streamlit UI ---
+RAW_JSON_LIMIT = 500
+
 st.title("📊 Excel Named Reference Dependency Viewer (Cloud-Safe)")
 
+use_batch_api = st.sidebar.checkbox(
+    "Use OpenAI Batch API",
+    help="Half the token cost, but explanations can take several minutes to arrive."
+)
+
 uploaded_files = st.file_uploader("Upload Excel files (.xlsx)", type=["xlsx"], accept_multiple_files=True)
 
 if uploaded_files:
-    combined_named_refs = {}
-
-    for uploaded_file in uploaded_files:
-        try:
-            wb = load_workbook(io.BytesIO(uploaded_file.read()), data_only=False)
-            refs = extract_named_references(wb, uploaded_file.name)
-            combined_named_refs.update(refs)
-        except Exception as e:
-            st.error(f"❌ Error reading {uploaded_file.name}: {e}")
+    files = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+    signature = tuple((file_name, hashlib.sha1(file_bytes).hexdigest()) for file_name, file_bytes in files)
+    combined_named_refs, dependencies = process_files(signature, files)
 
     if combined_named_refs:
         st.subheader("📌 Named References Extracted")
-        st.json(combined_named_refs)
+        # Arrow-backed, virtualized table instead of shipping the whole dict as a JSON tree.
+        # Built column by column so no per-row dicts are allocated.
+        columns = defaultdict(list)
+        for label, info in combined_named_refs.items():
+            columns["name"].append(label)
+            columns["file"].append(info["file"])
+            columns["sheet"].append(info["sheet"])
+            columns["ref"].append(info["ref"])
+            columns["scope"].append(info["scope"])
+            columns["formula"].append(" + ".join(info.get("formulas", [])))
+        named_refs_df = pd.DataFrame(columns)
+        st.dataframe(named_refs_df, use_container_width=True, hide_index=True)
+        st.download_button(
+            "Download as CSV",
+            named_refs_df.to_csv(index=False).encode(),
+            file_name="named_references.csv",
+            mime="text/csv"
+        )
+        # The JSON tree is only serialized and sent when asked for
+        if st.checkbox("Show raw extraction JSON"):
+            st.json(dict(itertools.islice(combined_named_refs.items(), RAW_JSON_LIMIT)), expanded=False)
+            if len(combined_named_refs) > RAW_JSON_LIMIT:
+                st.caption(f"Showing the first {RAW_JSON_LIMIT} of {len(combined_named_refs)} references; download the full extraction below.")
+            st.download_button(
+                "Download as JSON",
+                json.dumps(combined_named_refs, indent=2).encode(),
+                file_name="named_references.json",
+                mime="application/json"
+            )
 
         st.subheader("🔗 Dependency Graph")
-        dependencies = find_dependencies(combined_named_refs)
-        dot = create_dependency_graph(dependencies, combined_named_refs.keys())
-        st.graphviz_chart(dot)
+        # dot layout is superlinear in edges; large workbooks are best viewed a neighbourhood at a time
+        focus = st.sidebar.selectbox("Focus reference", [WHOLE_GRAPH] + list(combined_named_refs))
+        depth = st.sidebar.slider("Depth", 1, 4, 2, disabled=focus == WHOLE_GRAPH)
+        graph_key = (signature, focus, depth)
+        # Widget reruns with the same uploads and focus reuse the graph built for them
+        cached_graph = st.session_state.get("dependency_graph")
+        if cached_graph is None or cached_graph[0] != graph_key:
+            if focus == WHOLE_GRAPH:
+                labels = combined_named_refs.keys()
+            else:
+                labels = neighbourhood(dependencies, focus, depth)
+            cached_graph = (graph_key, create_dependency_graph(dependencies, labels, combined_named_refs))
+            st.session_state["dependency_graph"] = cached_graph
+        st.graphviz_chart(cached_graph[1])
 
         st.subheader("🧠 AI-Generated Formula Explanations")
-        with st.spinner("Calling GPT-4..."):
-            rows = generate_ai_outputs(combined_named_refs)
-            st.markdown(render_markdown_table(rows), unsafe_allow_html=True)
+        if use_batch_api:
+            run_batch_job(combined_named_refs)
+        table = st.empty()
+        with st.spinner(f"Calling {MODEL}..."):
+            rows = generate_ai_outputs(
+                combined_named_refs,
+                on_progress=lambda partial: table.dataframe(pd.DataFrame(partial), use_container_width=True, hide_index=True)
+            )
+        table.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+        st.download_button(
+            "Download as Markdown",
+            render_markdown_table(rows),
+            file_name="formula_explanations.md",
+            mime="text/markdown"
+        )
 
     else:
         st.warning("No named references found.")